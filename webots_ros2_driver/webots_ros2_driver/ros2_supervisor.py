@@ -19,29 +19,56 @@
 
 
 import os
+import re
 import sys
+import hashlib
+import tempfile
+import threading
 
 import rclpy
 import vehicle
 import controller
 import webots_ros2_importer
-from rclpy.time import Time
+from rclpy.callback_groups import MutuallyExclusiveCallbackGroup
+from rclpy.executors import MultiThreadedExecutor
 from rclpy.node import Node
-from rclpy.qos import qos_profile_services_default
+from rclpy.qos import QoSProfile, qos_profile_services_default
 from rosgraph_msgs.msg import Clock
 from std_msgs.msg import String
-sys.path.insert(1, os.path.join(os.path.dirname(webots_ros2_importer.__file__), 'urdf2webots'))
-from urdf2webots.importer import convertUrdfFile, convertUrdfContent
 from webots_ros2_msgs.srv import SpawnUrdfRobot, SpawnNodeFromString
-import re 
+# The linear-time google-re2 engine is used for node name extraction when available.
+try:
+    import re2 as _re_impl
+except ImportError:
+    _re_impl = re
+
+
+def _prepend_to_sys_path(path):
+    """Put `path` right after the script directory in `sys.path`, removing any other entry pointing to it."""
+    path = os.path.realpath(path)
+    sys.path[1:] = [path] + [entry for entry in sys.path[1:] if os.path.realpath(entry) != path]
+
+
+# urdf2webots is only imported when a URDF robot is converted for the first time.
+_prepend_to_sys_path(os.path.join(os.path.dirname(webots_ros2_importer.__file__), 'urdf2webots'))
 
 # As Ros2Supervisor needs the controller library, we extend the path here
 # to avoid to load another library named "controller" or "vehicle".
-sys.path.insert(1, os.path.dirname(vehicle.__file__))
-sys.path.insert(1, os.path.dirname(controller.__file__))
+_prepend_to_sys_path(os.path.dirname(vehicle.__file__))
+_prepend_to_sys_path(os.path.dirname(controller.__file__))
 from controller import Supervisor
 
 
+# Extracts the Webots node name from a VRML node string. The "name" keyword must start a field
+# (beginning of the string, whitespace or "{" before it) and the name length is bounded.
+_NAME_RE = _re_impl.compile(r'(?:^|[\s{])name\s+"([a-z0-9_]{0,256})"')
+# Matches any "name" field, to tell a missing name from an invalid one.
+_NAME_FIELD_RE = _re_impl.compile(r'(?:^|[\s{])name\s+"')
+
+# Memory-backed directory for the temporary files of the URDF converter (None falls back to the default one).
+TMPFS_DIRECTORY = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+
+
 class Ros2Supervisor(Node):
     def __init__(self):
         super().__init__('Ros2Supervisor')
@@ -49,21 +76,43 @@ class Ros2Supervisor(Node):
         self.__robot = Supervisor()
         self.__timestep = int(self.__robot.getBasicTimeStep())
 
-        # /clock topic
-        self.create_timer(1 / 1000, self.__supervisor_step_callback)
-        self.__clock_publisher = self.create_publisher(Clock, 'clock', 10)
+        # The step timer and the spawn callbacks run in separate callback groups so that a long URDF conversion
+        # does not stall /clock. The controller library is not thread-safe, so every Supervisor call is serialized.
+        self.__supervisor_lock = threading.Lock()
+        step_callback_group = MutuallyExclusiveCallbackGroup()
+        spawn_callback_group = MutuallyExclusiveCallbackGroup()
+
+        # /clock topic. robot.step() blocks until Webots completes the step, so a short period does not add steps
+        # but lets the simulation run as fast as Webots allows (e.g. in fast mode).
+        self.create_timer(1 / 1000, self.__supervisor_step_callback, callback_group=step_callback_group)
+        # Reliable with a depth of 1: no history is kept for old time stamps, and both reliable and best-effort
+        # subscribers (depending on the ROS distribution, the time source uses one or the other) are matched.
+        self.__clock_publisher = self.create_publisher(Clock, 'clock', QoSProfile(depth=1))
+        self.__clock_message = Clock()
+        # Bound once, as they are called at every simulation step.
+        self.__robot_step = self.__robot.step
+        self.__robot_get_time = self.__robot.getTime
+        self.__publish_clock = self.__clock_publisher.publish
 
         # Spawn Nodes (URDF robots or Webots objects)
         root_node = self.__robot.getRoot()
         self.__insertion_node_place = root_node.getField('children')
-        self.__node_list=[]
+        self.__node_set = set()
+        self.__name_to_node = {}
+        # Converted URDF robots, by hash of the converter arguments. The conversion also depends on the working
+        # directory, the ament package paths and the urdf2webots version, so it is only reused within this process.
+        self.__urdf_cache = {}
+        self.__convert_urdf_content = None
         
     
         # Services
-        self.create_service(SpawnUrdfRobot, 'spawn_urdf_robot', self.__spawn_urdf_robot_callback)
-        self.create_service(SpawnNodeFromString, 'spawn_node_from_string', self.__spawn_node_from_string_callback)        
+        self.create_service(SpawnUrdfRobot, 'spawn_urdf_robot', self.__spawn_urdf_robot_callback,
+                            callback_group=spawn_callback_group)
+        self.create_service(SpawnNodeFromString, 'spawn_node_from_string', self.__spawn_node_from_string_callback,
+                            callback_group=spawn_callback_group)
         # Subscriptions        
-        self.create_subscription(String, 'remove_node', self.__remove_imported_node_callback, qos_profile_services_default)
+        self.create_subscription(String, 'remove_node', self.__remove_imported_node_callback, qos_profile_services_default,
+                                 callback_group=spawn_callback_group)
         
    
 
@@ -76,8 +125,12 @@ class Ros2Supervisor(Node):
             self.get_logger().info('Ros2Supervisor cannot import an unnamed URDF robot. Please specifiy it with name="" in the URDFSpawner object.')
             response.success = False
             return response
-        if robot_name in self.__node_list:
-            self.get_logger().info('The URDF robot name "' + str(robot_name) + '" is already used by another robot! Please specifiy a unique name.')
+        if robot_name in self.__node_set:
+            self.get_logger().info(f'The URDF robot name "{robot_name}" is already used by another robot! Please specifiy a unique name.')
+            response.success = False
+            return response
+        if not robot.urdf_path and not robot.robot_description:
+            self.get_logger().info('Ros2Supervisor can not import a URDF file without a specified "urdf_path" or "robot_description" in the URDFSpawner object.')
             response.success = False
             return response
 
@@ -87,27 +140,55 @@ class Ros2Supervisor(Node):
         box_collision = robot.box_collision if robot.box_collision else False
         init_pos = robot.init_pos if robot.init_pos else None
 
-        # Choose the conversion according to the input
+        # Choose the content to convert according to the input. A URDF file is read only once here: its content
+        # is converted with the file directory as prefix for relative paths, exactly as convertUrdfFile would do.
         if robot.urdf_path:
-            robot_string = convertUrdfFile(input=robot.urdf_path, robotName=robot_name, normal=normal,
-                                    boxCollision=box_collision, initTranslation=robot_translation, initRotation=robot_rotation,
-                                    initPos=init_pos)
-        elif robot.robot_description:
-            relative_path_prefix = robot.relative_path_prefix if robot.relative_path_prefix else None
-            robot_string = convertUrdfContent(input=robot.robot_description, robotName=robot_name, normal=normal,
-                                        boxCollision=box_collision, initTranslation=robot_translation, initRotation=robot_rotation,
-                                        initPos=init_pos, relativePathPrefix=relative_path_prefix)
+            try:
+                with open(robot.urdf_path, 'r') as urdf_file:
+                    robot_description = urdf_file.read()
+            except OSError as error:
+                self.get_logger().info(f'Ros2Supervisor cannot read the URDF file "{robot.urdf_path}": {error.strerror}.')
+                response.success = False
+                return response
+            relative_path_prefix = os.path.dirname(os.path.abspath(robot.urdf_path))
         else:
-            self.get_logger().info('Ros2Supervisor can not import a URDF file without a specified "urdf_path" or "robot_description" in the URDFSpawner object.')
+            robot_description = robot.robot_description
+            relative_path_prefix = robot.relative_path_prefix if robot.relative_path_prefix else None
+        robot_string = self.__convert_urdf(input=robot_description, robotName=robot_name, normal=normal,
+                                           boxCollision=box_collision, initTranslation=robot_translation,
+                                           initRotation=robot_rotation, initPos=init_pos,
+                                           relativePathPrefix=relative_path_prefix)
+        with self.__supervisor_lock:
+            self.__insertion_node_place.importMFNodeFromString(-1, robot_string)
+            node = self.__get_imported_node(robot_name)
+        if not node:
+            self.get_logger().info(f'Ros2Supervisor could not import the URDF robot named "{robot_name}".')
             response.success = False
             return response
-        self.__insertion_node_place.importMFNodeFromString(-1, robot_string)
-        self.get_logger().info('Ros2Supervisor has imported the URDF robot named "' + str(robot_name) + '".')
-        self.__node_list.append(robot_name)
+        self.get_logger().info(f'Ros2Supervisor has imported the URDF robot named "{robot_name}".')
+        self.__node_set.add(robot_name)
         response.success = True
         return response
     
     
+    def __convert_urdf(self, **kwargs):
+        """Convert a URDF content, reusing the result of a previous conversion of the same inputs."""
+        key = hashlib.blake2b(repr(sorted(kwargs.items())).encode(), digest_size=20).hexdigest()
+        robot_string = self.__urdf_cache.get(key)
+        if robot_string is None:
+            if self.__convert_urdf_content is None:
+                from urdf2webots.importer import convertUrdfContent
+                self.__convert_urdf_content = convertUrdfContent
+            # The converter writes the robot string to a temporary file, kept in memory when a tmpfs is available.
+            default_tempdir = tempfile.tempdir
+            tempfile.tempdir = TMPFS_DIRECTORY
+            try:
+                robot_string = self.__convert_urdf_content(**kwargs)
+            finally:
+                tempfile.tempdir = default_tempdir
+            self.__urdf_cache[key] = robot_string
+        return robot_string
+
     def __spawn_node_from_string_callback(self, request, response):        
         object_string = request.data
         if(object_string == ''):
@@ -115,77 +196,113 @@ class Ros2Supervisor(Node):
             response.success = False
             return response
         # Extract Webots node name from string.
-        name_match = re.search('name "[a-z0-9_]*"', object_string)
-        object_name = name_match.group().replace('name ', '')
-        object_name = object_name.replace('"', '')
+        name_match = _NAME_RE.search(object_string)
+        if not name_match:
+            if _NAME_FIELD_RE.search(object_string):
+                self.get_logger().info('Ros2Supervisor cannot import a node with an invalid name. The name must contain at most '
+                                       '256 lowercase letters, digits or underscores.')
+            else:
+                self.get_logger().info('Ros2Supervisor cannot import a node without a "name" field.')
+            response.success = False
+            return response
+        object_name = name_match.group(1)
         # Check that the name is not an empty string.
         if object_name == '':
             self.get_logger().info('Ros2Supervisor cannot import an unnamed node.')            
             response.success = False
             return response
         # Check that the name is unique.
-        if object_name in self.__node_list:
-            self.get_logger().info('Ros2Supervisor has found a duplicate node in the world named "' + str(object_name) + '". Please specifiy a unique name.')
+        if object_name in self.__node_set:
+            self.get_logger().info(f'Ros2Supervisor has found a duplicate node in the world named "{object_name}". Please specifiy a unique name.')
             response.success = False
             return response
         # Insert the object.
-        self.__node_list.append(object_name)
-        self.__insertion_node_place.importMFNodeFromString(-1, object_string)
-        
-        # Check if the object has been imported into the world
-        node = None
-        node_imported_successfully = False
-        for id_node in range(self.__insertion_node_place.getCount()):
-            node = self.__insertion_node_place.getMFNode(id_node)
-            node_name_field = node.getField('name')
-            if node_name_field and node_name_field.getSFString() == object_name:
-                node_imported_successfully = True
-                break
-        if not node_imported_successfully:
-            self.__node_list.remove(object_name)
-            self.get_logger().info('Ros2Supervisor could not import the node named "' + str(object_name) + '".')
+        self.__node_set.add(object_name)
+        with self.__supervisor_lock:
+            self.__insertion_node_place.importMFNodeFromString(-1, object_string)
+
+            # Check if the object has been imported into the world.
+            node = self.__get_imported_node(object_name)
+        if not node:
+            self.__node_set.discard(object_name)
+            self.get_logger().info(f'Ros2Supervisor could not import the node named "{object_name}".')
             response.success = False
             return response
 
-        self.get_logger().info('Ros2Supervisor has imported the node named "' + str(object_name) + '".')
+        self.get_logger().info(f'Ros2Supervisor has imported the node named "{object_name}".')
         response.success = True
         return response
 
+    def __get_imported_node(self, name):
+        """Return the node just imported if it is named `name`, or None. The Supervisor lock must be held."""
+        # A rejected import leaves the previous last child in place, so its name must be checked.
+        node = self.__insertion_node_place.getMFNode(-1)
+        node_name_field = node.getField('name') if node else None
+        if node_name_field is None or node_name_field.getSFString() != name:
+            return None
+        self.__name_to_node[name] = node
+        return node
+
+    def __find_child_by_name(self, name):
+        """Return the child of the root children field named `name`, or None. The Supervisor lock must be held."""
+        node = self.__name_to_node.get(name)
+        if node is not None:
+            # The cached handle is checked again, in case the node was renamed or removed from the world.
+            node_name_field = node.getField('name')
+            if node_name_field is not None and node_name_field.getSFString() == name:
+                return node
+            del self.__name_to_node[name]
+        # Nodes are imported at the end of the field, so the newest ones are checked first.
+        place = self.__insertion_node_place
+        for id_node in range(place.getCount() - 1, -1, -1):
+            child = place.getMFNode(id_node)
+            child_name_field = child.getField('name')
+            if child_name_field is not None and child_name_field.getSFString() == name:
+                self.__name_to_node[name] = child
+                return child
+        return None
+
     # Allows to remove any imported node (urdf robots / VRML Nodes) by name.
     def __remove_imported_node_callback(self, message):
         name = message.data
 
-        if name in self.__node_list:
-            node = None
-
-            for id_node in range(self.__insertion_node_place.getCount()):
-                node = self.__insertion_node_place.getMFNode(id_node)
-                node_name_field = node.getField('name')
-                if node_name_field and node_name_field.getSFString() == name:
-                    node = node
-                    break
-
-            if node:
-                node.remove()
-                self.__node_list.remove(name)
-                self.get_logger().info('Ros2Supervisor has removed the node named "' + str(name) + '".')
-            else:
-                self.get_logger().info('Ros2Supervisor wanted to remove the node named "' + str(name) +
-                                    '" but this node has not been found in the simulation world.')
+        # Only imported nodes can be removed, not the ones of the world file.
+        node = None
+        if name in self.__node_set:
+            with self.__supervisor_lock:
+                node = self.__find_child_by_name(name)
+                if node:
+                    node.remove()
+        if node:
+            self.__name_to_node.pop(name, None)
+            self.__node_set.discard(name)
+            self.get_logger().info(f'Ros2Supervisor has removed the node named "{name}".')
+        else:
+            self.get_logger().info(f'Ros2Supervisor wanted to remove the node named "{name}" '
+                                   'but this node has not been found in the simulation world.')
 
     def __supervisor_step_callback(self):
-        if self.__robot.step(self.__timestep) < 0:
-            self.get_logger().info('Ros2Supervisor is shutting down...')
-        else:
-            clock_message = Clock()
-            clock_message.clock = Time(seconds=self.__robot.getTime()).to_msg()
-            self.__clock_publisher.publish(clock_message)
+        with self.__supervisor_lock:
+            if self.__robot_step(self.__timestep) < 0:
+                self.get_logger().info('Ros2Supervisor is shutting down...')
+                return
+            time = self.__robot_get_time()
+
+        # The simulation keeps running, but the message is not built when nobody listens to /clock.
+        if self.__clock_publisher.get_subscription_count() == 0:
+            return
+        # Rounded to the nanosecond, as truncating the float product can be off by 1 ns (e.g. 1.15 s).
+        clock = self.__clock_message.clock
+        clock.sec, clock.nanosec = divmod(round(time * 1_000_000_000), 1_000_000_000)
+        self.__publish_clock(self.__clock_message)
 
 
 def main(args=None):
     rclpy.init(args=args)
     ros_2_supervisor = Ros2Supervisor()
-    rclpy.spin(ros_2_supervisor)
+    executor = MultiThreadedExecutor(num_threads=2)
+    executor.add_node(ros_2_supervisor)
+    executor.spin()
     rclpy.shutdown()
 
 